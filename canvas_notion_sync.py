@@ -1,10 +1,14 @@
-import os, sys, time, json, pathlib, requests, re
+import os, sys, time, json, pathlib, requests, re, threading, hashlib, html
+import orjson
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime, timedelta, timezone
-from dateutil import parser as dateparser
 from dotenv import load_dotenv
-from notion_client import Client as NotionClient
-from typing import Dict, Any, List, Optional
-import pytz
+from notion_client import Client as NotionClient, APIResponseError, APIErrorCode
+from typing import Callable, Deque, Dict, Any, List, Optional
+from zoneinfo import ZoneInfo
 
 load_dotenv()
 
@@ -37,13 +41,33 @@ if not COURSE_IDS:
 
 # ---------- Clients ----------
 notion = NotionClient(auth=NOTION_TOKEN)
-tz = pytz.timezone(TIMEZONE)
+NOTION_RATE = 3  # requests per second allowed per integration
+NOTION_POOL = ThreadPoolExecutor(max_workers=NOTION_RATE)
+CANVAS_CONCURRENCY = 8  # courses fetched from Canvas at once
+tz = ZoneInfo(TIMEZONE)
 CANVAS_HEADERS = {"Authorization": f"Bearer {CANVAS_TOKEN}"}
 
+# one pooled keep-alive session for all Canvas calls
+SESSION = requests.Session()
+SESSION.headers.update(CANVAS_HEADERS)
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False),
+))
+
 # ---------- Local state ----------
 STATE_DIR = pathlib.Path(".state")
 STATE_DIR.mkdir(exist_ok=True)
 LAST_SYNC_FILE = STATE_DIR / "last_sync.txt"
+FINGERPRINT_FILE = STATE_DIR / "page_fingerprints.json"
+FINGERPRINTS: Dict[int, str] = {}
+ETAG_FILE = STATE_DIR / "etags.json"
+ETAG_BODY_DIR = STATE_DIR / "etag_bodies"
+ETAGS: Dict[str, str] = {}
+_ETAG_LOCK = threading.Lock()
+UPDATED_AT_FILE = STATE_DIR / "assignment_updated.json"
+UPDATED_AT: Dict[int, List[str]] = {}
 
 def now_local() -> datetime:
     return datetime.now(tz)
@@ -53,7 +77,7 @@ def load_last_sync() -> Optional[datetime]:
         s = LAST_SYNC_FILE.read_text().strip()
         if s:
             try:
-                return dateparser.parse(s).astimezone(tz)
+                return parse_canvas_time(s)
             except Exception:
                 return None
     return None
@@ -61,17 +85,42 @@ def load_last_sync() -> Optional[datetime]:
 def save_last_sync(dt: datetime) -> None:
     LAST_SYNC_FILE.write_text(dt.astimezone(timezone.utc).isoformat())
 
+def load_state_map(path: pathlib.Path, target: Dict[Any, Any], int_keys: bool = False) -> None:
+    target.clear()
+    if path.exists():
+        try:
+            data = json.loads(path.read_text())
+        except (ValueError, OSError):
+            return
+        # JSON object keys are always strings; packed ikey maps need them back as ints
+        target.update({int(k): v for k, v in data.items()} if int_keys else data)
+
+def save_state_map(path: pathlib.Path, data: Dict[Any, Any]) -> None:
+    # write then rename so an interrupted run never leaves a truncated file
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(data, sort_keys=True))
+    os.replace(tmp, path)
+
+def fingerprint(*fields: Any) -> str:
+    return hashlib.blake2b(repr(fields).encode(), digest_size=16).hexdigest()
+
 # ---------- Canvas helpers ----------
-def canvas_get(url: str, params: Dict[str, Any] = None) -> List[Dict[str, Any]]:
+def canvas_get(
+    url: str,
+    params: Dict[str, Any] = None,
+    max_items: Optional[int] = None,
+) -> List[Dict[str, Any]]:
     items: List[Dict[str, Any]] = []
     next_url = url
     local_params = params.copy() if params else {}
     while next_url:
-        resp = requests.get(next_url, headers=CANVAS_HEADERS, params=local_params, timeout=30)
+        resp = SESSION.get(next_url, params=local_params, timeout=30)
         resp.raise_for_status()
-        data = resp.json()
+        data = orjson.loads(resp.content)
         if isinstance(data, list):
             items.extend(data)
+            if max_items and len(items) >= max_items:
+                return items[:max_items]
         else:
             return data
         link = resp.headers.get("Link", "")
@@ -88,13 +137,35 @@ def canvas_get(url: str, params: Dict[str, Any] = None) -> List[Dict[str, Any]]:
         local_params = {}
     return items
 
+def conditional_get(url: str, timeout: int = 20) -> Optional[Any]:
+    # send the stored ETag and reuse the cached body when Canvas answers 304
+    body_file = ETAG_BODY_DIR / f"{hashlib.blake2b(url.encode(), digest_size=16).hexdigest()}.json"
+    headers: Dict[str, str] = {}
+    prev_etag = ETAGS.get(url)
+    if prev_etag and body_file.exists():
+        headers["If-None-Match"] = prev_etag
+    r = SESSION.get(url, headers=headers, timeout=timeout)
+    if r.status_code == 304:
+        try:
+            return orjson.loads(body_file.read_bytes())
+        except (ValueError, OSError):
+            r = SESSION.get(url, timeout=timeout)
+    if r.status_code != 200:
+        return None
+    data = orjson.loads(r.content)
+    etag = r.headers.get("ETag")
+    if etag:
+        ETAG_BODY_DIR.mkdir(exist_ok=True)
+        body_file.write_bytes(r.content)
+        with _ETAG_LOCK:
+            ETAGS[url] = etag
+    return data
+
 def get_course(course_id: int) -> Optional[Dict[str, Any]]:
     url = f"{CANVAS_BASE_URL}/api/v1/courses/{course_id}"
     try:
-        r = requests.get(url, headers=CANVAS_HEADERS, timeout=20)
-        if r.status_code == 200:
-            return r.json()
-    except requests.RequestException:
+        return conditional_get(url)
+    except (requests.RequestException, ValueError):  # orjson decode errors are ValueError
         pass
     return None
 
@@ -119,24 +190,32 @@ def get_submissions_changed_since(course_id: int, since_iso: str) -> List[Dict[s
 def parse_canvas_time(iso_str: Optional[str]) -> Optional[datetime]:
     if not iso_str:
         return None
-    dt = dateparser.parse(iso_str)
+    # Canvas sends ISO 8601 with a Z suffix; only fall back to dateutil for anything else
+    try:
+        dt = datetime.fromisoformat(iso_str.replace("Z", "+00:00"))
+    except ValueError:
+        from dateutil import parser as dateparser  # only needed for non-ISO input
+        dt = dateparser.parse(iso_str)
     if not dt.tzinfo:
-        dt = pytz.UTC.localize(dt)
+        dt = dt.replace(tzinfo=timezone.utc)
     return dt.astimezone(tz)
 
 def time_str(dt: datetime) -> str:
-    return dt.strftime("%I:%M %p").lstrip("0")
+    h = dt.hour
+    return f"{(h - 1) % 12 + 1}:{dt.minute:02d} {'AM' if h < 12 else 'PM'}"
 
 # ---------- Notion schema ----------
 _DB_SCHEMA: Dict[str, Any] = {}
 _SELECT_CACHE: Dict[str, bool] = {}
 _STATUS_IS_STATUS_TYPE = True
+_SCHEMA_LOCK = threading.Lock()
 
 def load_db_schema() -> Dict[str, Any]:
     global _DB_SCHEMA
-    if not _DB_SCHEMA:
-        _DB_SCHEMA = notion.databases.retrieve(NOTION_DATABASE_ID)
-    return _DB_SCHEMA
+    with _SCHEMA_LOCK:
+        if not _DB_SCHEMA:
+            _DB_SCHEMA = notion.databases.retrieve(NOTION_DATABASE_ID)
+        return _DB_SCHEMA
 
 def db_has_property(name: str) -> bool:
     return name in load_db_schema().get("properties", {})
@@ -194,7 +273,8 @@ def property_is_select(prop: str) -> bool:
         return _SELECT_CACHE[prop]
     p = load_db_schema()["properties"].get(prop)
     is_select = p and p.get("type") in ["select", "multi_select"]
-    _SELECT_CACHE[prop] = bool(is_select)
+    with _SCHEMA_LOCK:
+        _SELECT_CACHE[prop] = bool(is_select)
     return bool(is_select)
 
 def status_prop_value(status_name: str) -> Dict[str, Any]:
@@ -204,34 +284,96 @@ def status_prop_value(status_name: str) -> Dict[str, Any]:
 
 # ---------- Upsert helpers ----------
 def key_for(course_id: int, assignment_id: int) -> str:
+    # string form written to the Notion Key property
     return f"{course_id}:{assignment_id}"
 
-def find_by_key(key: str) -> Optional[str]:
-    # ensure schema before querying by Key
-    if not db_has_property("Key"):
-        ensure_schema()
+def ikey(course_id: int, assignment_id: int) -> int:
+    # packed form used for the in-memory and .state caches
+    return (course_id << 64) | assignment_id
+
+def ikey_from_key(key: str) -> Optional[int]:
+    cid, _, aid = key.partition(":")
+    if cid.isdigit() and aid.isdigit():
+        return ikey(int(cid), int(aid))
+    return None
+
+_NOTION_CALLS: Deque[float] = deque()
+_NOTION_LOCK = threading.Lock()
+
+def notion_throttle() -> None:
+    # sliding one second window shared by every thread writing to Notion
+    while True:
+        with _NOTION_LOCK:
+            now = time.monotonic()
+            while _NOTION_CALLS and now - _NOTION_CALLS[0] >= 1.0:
+                _NOTION_CALLS.popleft()
+            if len(_NOTION_CALLS) < NOTION_RATE:
+                _NOTION_CALLS.append(now)
+                return
+            delay = 1.0 - (now - _NOTION_CALLS[0])
+        time.sleep(delay)
+
+def notion_call(fn: Callable[..., Any], attempts: int = 5, **kwargs: Any) -> Any:
+    # throttled Notion request; rate-limited responses are retried, anything else raises
+    for attempt in range(attempts):
+        notion_throttle()
+        try:
+            return fn(**kwargs)
+        except APIResponseError as e:
+            if e.code != APIErrorCode.RateLimited or attempt == attempts - 1:
+                raise
+            retry_after = getattr(e, "headers", {}).get("Retry-After")
+            time.sleep(float(retry_after) if retry_after else 2 ** attempt)
+
+PAGE_CACHE: Dict[int, str] = {}
+
+def load_page_cache() -> None:
+    # one paginated scan of the database instead of a query per assignment.
+    # A partial cache would make full_scan create duplicate rows, so any failure aborts the run.
+    PAGE_CACHE.clear()
+    cursor: Optional[str] = None
     try:
-        res = notion.databases.query(
-            database_id=NOTION_DATABASE_ID,
-            filter={"property": "Key", "rich_text": {"equals": key}},
-            page_size=1,
-        )
-        results = res.get("results", [])
-        if results:
-            return results[0]["id"]
+        while True:
+            query: Dict[str, Any] = {
+                "database_id": NOTION_DATABASE_ID,
+                "filter": {"property": "Key", "rich_text": {"is_not_empty": True}},
+                "page_size": 100,
+            }
+            if cursor:
+                query["start_cursor"] = cursor
+            res = notion_call(notion.databases.query, **query)
+            for page in res.get("results", []):
+                rich = page.get("properties", {}).get("Key", {}).get("rich_text", [])
+                k = ikey_from_key("".join(r.get("plain_text", "") for r in rich))
+                if k is not None:
+                    PAGE_CACHE[k] = page["id"]
+            if not res.get("has_more"):
+                break
+            cursor = res.get("next_cursor")
     except Exception as e:
-        print(f"Notion query by Key failed: {e}")
-    return None
+        print(f"Notion page scan failed: {e}")
+        raise
 
-def upsert_page(props: Dict[str, Any], page_id: Optional[str]) -> None:
+def find_by_key(key: int) -> Optional[str]:
+    # PAGE_CACHE is filled once by load_page_cache() after ensure_schema() in main()
+    return PAGE_CACHE.get(key)
+
+def upsert_page(props: Dict[str, Any], page_id: Optional[str]) -> bool:
     # props is the raw Notion properties dict. Do not wrap again.
     try:
         if page_id:
-            notion.pages.update(page_id=page_id, properties=props)
+            notion_call(notion.pages.update, page_id=page_id, properties=props)
         else:
-            notion.pages.create(parent={"database_id": NOTION_DATABASE_ID}, properties=props)
+            notion_call(notion.pages.create, parent={"database_id": NOTION_DATABASE_ID}, properties=props)
+        return True
     except Exception as e:
         print(f"Notion upsert failed: {e}")
+        return False
+
+def upsert_and_record(key: int, fp: str, seen: List[str], props: Dict[str, Any], page_id: Optional[str]) -> None:
+    if upsert_page(props, page_id):
+        FINGERPRINTS[key] = fp
+        UPDATED_AT[key] = seen
 
 # ---------- Mapping ----------
 EXAM_KEYWORDS = ["exam", "midterm", "final"]
@@ -244,7 +386,7 @@ def classify_type(assignment: Dict[str, Any]) -> str:
         return "Exam"
     return "Assignment"
 
-def decide_status_from_submission(sub: Optional[Dict[str, Any]], due_dt: Optional[datetime]) -> str:
+def decide_status_from_submission(sub: Optional[Dict[str, Any]], due_dt: Optional[datetime], now: datetime) -> str:
     if sub:
         state = sub.get("workflow_state")
         submitted_at = sub.get("submitted_at")
@@ -252,12 +394,12 @@ def decide_status_from_submission(sub: Optional[Dict[str, Any]], due_dt: Optiona
             return "Complete"
         if state in {"pending_review"}:
             return "In Progress"
-    if due_dt and due_dt < now_local():
+    if due_dt and due_dt < now:
         return "DNF"
     return "To do"
 
 # ---------- Delta sync for recent submission changes ----------
-def sync_status_deltas_since(course_id: int, since_dt: datetime) -> None:
+def sync_status_deltas_since(course_id: int, since_dt: datetime, now: datetime) -> None:
     since_iso = since_dt.astimezone(timezone.utc).isoformat().replace("+00:00", "Z")
     try:
         changed = get_submissions_changed_since(course_id, since_iso)
@@ -270,12 +412,12 @@ def sync_status_deltas_since(course_id: int, since_dt: datetime) -> None:
         aid = a.get("id")
         if not aid:
             continue
-        key = key_for(course_id, aid)
+        key = ikey(course_id, aid)
         page_id = find_by_key(key)
         if not page_id:
             continue  # will be created during full scan
         due_dt = parse_canvas_time(a.get("due_at"))
-        status_value = decide_status_from_submission(s, due_dt)
+        status_value = decide_status_from_submission(s, due_dt, now)
         props: Dict[str, Any] = {
             "Status": status_prop_value(status_value),
         }
@@ -287,82 +429,127 @@ def sync_status_deltas_since(course_id: int, since_dt: datetime) -> None:
         assignment_url = f"{CANVAS_BASE_URL}/courses/{course_id}/assignments/{aid}"
         props["Submission Link"] = {"url": assignment_url}
         
-        upsert_page(props, page_id)
+        if upsert_page(props, page_id):
+            # the page no longer matches what full_scan last wrote, so make it rewrite the row
+            FINGERPRINTS.pop(key, None)
+            UPDATED_AT.pop(key, None)
 
 # ---------- Full scan within window ----------
-def full_scan(course_id: int, course_name: str, horizon_start: datetime, horizon_end: datetime) -> None:
-    assignments = get_course_assignments_with_submissions(course_id)
-    for a in assignments:
-        due_at_local = parse_canvas_time(a.get("due_at"))
-        if not due_at_local:
-            continue
-        if due_at_local < horizon_start or due_at_local > horizon_end:
-            continue
+_TAG_RE = re.compile(r'<[^>]+>', re.DOTALL)
 
-        type_str = classify_type(a)
-        submission = a.get("submission")
-        status_value = decide_status_from_submission(submission, due_at_local)
-
-        task_name = a.get("name") or f"Assignment {a['id']}"
-        key = key_for(course_id, a["id"])
+def full_scan(course_id: int, course_name: str, horizon_start: datetime, horizon_end: datetime, now: datetime) -> None:
+    assignments = get_course_assignments_with_submissions(course_id)
+    pending = []
+    # the Class value is the same for every row in this course
+    if property_is_select("Class"):
+        class_prop = {"select": {"name": course_name}}
+    else:
+        class_prop = {"rich_text": [{"type": "text", "text": {"content": course_name}}]}
+    try:
+        for a in assignments:
+            due_at_local = parse_canvas_time(a.get("due_at"))
+            if not due_at_local:
+                continue
+            if due_at_local < horizon_start or due_at_local > horizon_end:
+                continue
+
+            type_str = classify_type(a)
+            submission = a.get("submission")
+            status_value = decide_status_from_submission(submission, due_at_local, now)
+
+            task_name = a.get("name") or f"Assignment {a['id']}"
+            due_iso = due_at_local.isoformat()
+            key = ikey(course_id, a["id"])
+            page_id = find_by_key(key)
+
+            # status can flip to DNF with no Canvas edit, so it is part of the comparison
+            seen = [a.get("updated_at"), status_value, course_name]
+            if page_id and seen[0] and UPDATED_AT.get(key) == seen:
+                continue
         
-        # Extract assignment description
-        description = a.get("description", "")
-        if description:
-            # Clean up HTML tags and convert to plain text for better readability
-            description = re.sub(r'<[^>]+>', '', description)  # Remove HTML tags
-            description = description.strip()
+            # Extract assignment description
+            description = a.get("description") or ""
+            if description:
+                # Clean up HTML tags and convert to plain text for better readability
+                description = html.unescape(_TAG_RE.sub('', description)).strip()  # Remove HTML tags and entities
         
-        # build properties
-        props: Dict[str, Any] = {
-            "Task": {"title": [{"type": "text", "text": {"content": task_name[:1000]}}]},
-            "Type": {"select": {"name": type_str}},
-            "Status": status_prop_value(status_value),
-            "Key": {"rich_text": [{"type": "text", "text": {"content": key}}]},
-            "Due": {"date": {"start": due_at_local.isoformat()}},
-            "Time": {"rich_text": [{"type": "text", "text": {"content": time_str(due_at_local)}}]},
-        }
+            # build properties
+            props: Dict[str, Any] = {
+                "Task": {"title": [{"type": "text", "text": {"content": task_name[:1000]}}]},
+                "Type": {"select": {"name": type_str}},
+                "Status": status_prop_value(status_value),
+                "Key": {"rich_text": [{"type": "text", "text": {"content": key_for(course_id, a["id"])}}]},
+                "Due": {"date": {"start": due_iso}},
+                "Time": {"rich_text": [{"type": "text", "text": {"content": time_str(due_at_local)}}]},
+            }
         
-        # Add Notes field with assignment description
-        if description:
-            props["Notes"] = {"rich_text": [{"type": "text", "text": {"content": description[:2000]}}]}
+            # Add Notes field with assignment description
+            if description:
+                props["Notes"] = {"rich_text": [{"type": "text", "text": {"content": description[:2000]}}]}
         
-        # Add Submission Link field with assignment URL
-        assignment_url = f"{CANVAS_BASE_URL}/courses/{course_id}/assignments/{a['id']}"
-        props["Submission Link"] = {"url": assignment_url}
+            # Add Submission Link field with assignment URL
+            assignment_url = f"{CANVAS_BASE_URL}/courses/{course_id}/assignments/{a['id']}"
+            props["Submission Link"] = {"url": assignment_url}
         
-        if property_is_select("Class"):
-            props["Class"] = {"select": {"name": course_name}}
-        else:
-            props["Class"] = {"rich_text": [{"type": "text", "text": {"content": course_name}}]}
+            props["Class"] = class_prop
 
-        page_id = find_by_key(key)
-        upsert_page(props, page_id)
-        time.sleep(0.1)
+            fp = fingerprint(task_name, type_str, status_value, due_iso, description[:2000], course_name)
+            if page_id and FINGERPRINTS.get(key) == fp:
+                UPDATED_AT[key] = seen
+                continue  # nothing changed since the last write
+            pending.append(NOTION_POOL.submit(upsert_and_record, key, fp, seen, props, page_id))
+    finally:
+        # let submitted writes finish before main() serialises the state maps
+        wait(pending)
 
 # ---------- Main ----------
+def sync_course(cid: int, horizon_start: datetime, horizon_end: datetime, last_sync: Optional[datetime], now: datetime) -> str:
+    course = get_course(cid)
+    if not course:
+        return f"- Could not load course {cid}"
+    course_name = OVERRIDES.get(cid) or course.get("course_code") or course.get("name") or f"Course {cid}"
+
+    if last_sync:
+        sync_status_deltas_since(cid, last_sync, now)
+
+    full_scan(cid, course_name, horizon_start, horizon_end, now)
+    return f"- {course_name} ({cid})"
+
 def main() -> None:
+    # schema is mutated here only, before any worker threads start
     ensure_schema()
-
-    horizon_start = now_local() - timedelta(days=7)
-    horizon_end = now_local() + timedelta(days=LOOKAHEAD_DAYS)
+    load_page_cache()
+    load_state_map(FINGERPRINT_FILE, FINGERPRINTS, int_keys=True)
+    load_state_map(ETAG_FILE, ETAGS)
+    load_state_map(UPDATED_AT_FILE, UPDATED_AT, int_keys=True)
+
+    now = now_local()
+    horizon_start = now - timedelta(days=7)
+    horizon_end = now + timedelta(days=LOOKAHEAD_DAYS)
     last_sync = load_last_sync()
 
     print("Fetching filtered courses...")
-    for cid in COURSE_IDS:
-        course = get_course(cid)
-        if not course:
-            print(f"- Could not load course {cid}")
-            continue
-        course_name = OVERRIDES.get(cid) or course.get("course_code") or course.get("name") or f"Course {cid}"
-        print(f"- {course_name} ({cid})")
-
-        if last_sync:
-            sync_status_deltas_since(cid, last_sync)
-
-        full_scan(cid, course_name, horizon_start, horizon_end)
-
-    save_last_sync(now_local())
+    failed = False
+    with ThreadPoolExecutor(max_workers=min(len(COURSE_IDS), CANVAS_CONCURRENCY)) as pool:
+        futures = {
+            pool.submit(sync_course, cid, horizon_start, horizon_end, last_sync, now): cid
+            for cid in COURSE_IDS
+        }
+        for fut in as_completed(futures):
+            try:
+                print(fut.result())
+            except Exception as e:
+                failed = True
+                print(f"- Course {futures[fut]} failed: {e}")
+
+    save_state_map(FINGERPRINT_FILE, FINGERPRINTS)
+    save_state_map(ETAG_FILE, ETAGS)
+    save_state_map(UPDATED_AT_FILE, UPDATED_AT)
+    if failed:
+        # keep the old last_sync so the next delta window still covers the failed courses
+        print("Sync finished with errors; last sync time not updated.")
+        return
+    save_last_sync(now)
     print("Sync complete.")
 
 if __name__ == "__main__":